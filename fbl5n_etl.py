@@ -1,28 +1,77 @@
 import logging
 import os
-from typing import List, Tuple, Union
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
 import pathlib
 import sys
-import boto3
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import io
+from pyarrow import csv as pa_csv
 from unidecode import unidecode
 
 sys.path.append(str(pathlib.Path(__file__).parent.absolute()))
 
-from utils.database import insert_into_database, execute_query
-from utils.helpers import create_parquet_key, create_parquet_and_send_to_s3, \
-    parse_sap_format_to_number, read_file, move_file_to_final_state, add_meta_columns, create_unique_id, get_file_date
+from utils.database import database_connection, transaction_scope, execute_statement, fetch_one, \
+    create_table_statement, bulk_insert_dataframe
+from utils.helpers import get_s3_client, create_parquet_key, create_parquet_and_send_to_s3, \
+    parse_sap_format_series_to_number, parse_sap_format_series_to_cents, parse_sap_format_series_to_date, \
+    read_file, read_file_stream, read_file_ranges, iter_bytes_chunks, decompress_chunks, sniff_encoding, \
+    decode_chunks, split_lines, concat_dataframes, create_row_hash, \
+    create_manifest_key, is_file_processed, mark_file_processed, object_exists_in_s3, move_file_to_final_state, \
+    add_meta_columns, get_file_date
 
 SYSTEM_NAME = 'sap'
 DATABASE = 'fbl5n'
 TABLE_NAME = 'fbl5n'
 
 DATABASE_TABLE_NAME = 'fbl5n_stage'
+STAGING_TABLE_NAME = '#fbl5n_stage_load'
+MERGE_PROGRESS_TABLE_NAME = 'fbl5n_merge_progress'
 TABLE_PRIMARY_KEY = 'key_unique_fbl5n'
+ROW_HASH_COLUMN = 'row_hash'
 
 NUMBER_COLUMNS = ['conta', 'mont_em_mi', 'datr', 'itm', 'conta_do_razao', 'are', 'doccompens']
 DATE_COLUMNS = ['data_doc_', 'vencliquid', 'compensac_', 'data_base', 'entrado_em']
+MONEY_COLUMNS = ['mont_em_mi']
+CATEGORY_COLUMNS = ['st', 'tip', 'are', 'tipo_de_cliente']
+META_COLUMNS = ['file_name', 'file_date', 'processing_date']
+
+MINIMUM_AMOUNT = 10
+
+HEADER_PREFIX = '|   St|'
+ENCODING_MARKERS = ['Nº', 'Razão']
+STRING_COLUMNS = ['Nº ID fiscal 1', 'Nº doc.   ', 'DocCompens', 'Conta do Razão  ', 'ChvRefer 3   ']
+
+STREAM_BATCH_ROWS = int(os.environ.get('FBL5N_STREAM_BATCH_ROWS', '0'))
+PARSE_ENGINE = os.environ.get('FBL5N_PARSE_ENGINE', 'csv')
+FIXED_WIDTH_BLOCK_ROWS = 65536
+ARROW_BLOCK_SIZE = int(os.environ.get('FBL5N_ARROW_BLOCK_SIZE', str(4 * 1024 * 1024)))
+EXACT_MONEY = os.environ.get('FBL5N_EXACT_MONEY', 'false').lower() == 'true'
+MERGE_BATCH_ROWS = int(os.environ.get('FBL5N_MERGE_BATCH_ROWS', '0'))
+RANGED_READ_PART_SIZE = int(os.environ.get('FBL5N_RANGED_READ_PART_SIZE', '0'))
+
+STAGING_COLUMN_TYPES = {
+    TABLE_PRIMARY_KEY: 'VARCHAR(64) NOT NULL',
+    ROW_HASH_COLUMN: 'BIGINT NOT NULL',
+    'conta': 'BIGINT',
+    'doccompens': 'BIGINT',
+    'conta_do_razao': 'BIGINT',
+    'mont_em_mi': 'BIGINT' if EXACT_MONEY else 'DECIMAL(19, 2)',
+    'datr': 'BIGINT',
+    'itm': 'INT',
+    'are': 'BIGINT',
+    'data_doc_': 'DATE',
+    'vencliquid': 'DATE',
+    'compensac_': 'DATE',
+    'data_base': 'DATE',
+    'entrado_em': 'DATE',
+    'tipo_de_cliente': 'VARCHAR(4)',
+    'file_date': 'DATE',
+    'processing_date': 'DATE',
+}
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
@@ -31,33 +80,29 @@ LOGGER.setLevel(logging.INFO)
 def handler(event, _):
     LOGGER.info('AWS lambda - FBL5N ETL execution started!')
 
-    s3_client = boto3.client(
-        's3',
-        endpoint_url=os.environ['S3_ENDPOINT_URL']
-    )
+    s3_client = get_s3_client()
 
     for record in event['Records']:
         LOGGER.info(f'AWS lambda - FBL5N ETL - Processing Record: {record}')
         bucket, original_key, state = parse_record(record)
+        metrics = {}
 
         try:
-            file = read_file(s3_client, bucket, original_key)
+            manifest_key = create_manifest_key(s3_client, record, SYSTEM_NAME, DATABASE)
 
-            try:
-                lines = file.decode('utf-8').split('\n')
-            except UnicodeDecodeError:
-                lines = file.decode('iso-8859-1').split('\n')
+            if is_file_processed(s3_client, bucket, manifest_key):
+                LOGGER.info(f'AWS lambda - FBL5N ETL - File already processed, skipping: {original_key}')
 
-            df = parse_lines_to_dataframe(lines)
+                if object_exists_in_s3(s3_client, bucket, original_key):
+                    move_file_to_final_state(s3_client, bucket, SYSTEM_NAME, DATABASE, original_key, 'processed')
+                else:
+                    LOGGER.info(f'AWS lambda - FBL5N ETL - File already moved to its final state: {original_key}')
 
-            LOGGER.info(f'AWS lambda - FBL5N ETL - Processing {len(df)} rows')
+                continue
 
-            structured_df = structure_dataframe(df)
-            cleaned_df = clean_dataframe(structured_df)
+            cleaned_df = load_cleaned_dataframe(s3_client, bucket, original_key, metrics)
             final_df = add_meta_columns(cleaned_df, original_key)
 
-            insert_processed_dataframe_in_database(final_df)
-
             file_date = get_file_date(original_key, r'\d{2}_\d{2}_\d{4}', '%d_%m_%Y')
 
             parquet_key = create_parquet_key(file_date,
@@ -65,10 +110,21 @@ def handler(event, _):
                                              DATABASE,
                                              state)
 
-            create_parquet_and_send_to_s3(s3_client, bucket, parquet_key, final_df)
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                database_future = executor.submit(insert_processed_dataframe_in_database, final_df)
+                parquet_future = executor.submit(create_parquet_and_send_to_s3, s3_client, bucket, parquet_key,
+                                                 final_df, MONEY_COLUMNS if EXACT_MONEY else None,
+                                                 database_future.result)
+
+                metrics.update(database_future.result())
+                parquet_future.result()
+
+            mark_file_processed(s3_client, bucket, manifest_key, original_key, metrics)
 
             move_file_to_final_state(s3_client, bucket, SYSTEM_NAME, DATABASE, original_key, 'processed')
 
+            LOGGER.info(f'AWS lambda - FBL5N ETL - Metrics: {metrics}')
+
         except Exception as ex:
             LOGGER.error(f'AWS lambda - FBL5N ETL - Execution failed: {ex}')
             move_file_to_final_state(s3_client, bucket, SYSTEM_NAME, DATABASE, original_key, 'error')
@@ -77,16 +133,65 @@ def handler(event, _):
     LOGGER.info('AWS lambda - FBL5N ETL - Execution finished!')
 
 
-def add_unique_key(df: pd.DataFrame) -> pd.DataFrame:
-    inside_df = df.copy()
+def load_cleaned_dataframe(s3_client,
+                           bucket: str,
+                           key: str,
+                           metrics: Dict[str, Union[str, int]]) -> pd.DataFrame:
+    if RANGED_READ_PART_SIZE > 0:
+        chunks = read_file_ranges(s3_client, bucket, key, RANGED_READ_PART_SIZE)
+    elif STREAM_BATCH_ROWS > 0:
+        chunks = read_file_stream(s3_client, bucket, key)
+    else:
+        chunks = iter_bytes_chunks(read_file(s3_client, bucket, key))
+
+    compression, chunks = decompress_chunks(chunks)
+    metrics['compression'] = compression or 'none'
+
+    if compression:
+        LOGGER.info(f'AWS lambda - FBL5N ETL - Decompressing {compression} file')
+
+    encoding, chunks = sniff_encoding(chunks, ENCODING_MARKERS)
+    metrics['encoding'] = encoding
+
+    LOGGER.info(f'AWS lambda - FBL5N ETL - Decoding file as {encoding}')
+
+    lines = split_lines(decode_chunks(chunks, encoding))
+
+    if STREAM_BATCH_ROWS > 0:
+        return structure_and_clean_batches(parse_lines_to_batches(lines, STREAM_BATCH_ROWS), metrics)
+
+    df = parse_lines_to_dataframe(list(lines))
+
+    LOGGER.info(f'AWS lambda - FBL5N ETL - Processing {len(df)} rows')
+
+    structured_df = structure_dataframe(df)
+
+    return clean_dataframe(structured_df, metrics)
+
+
+def structure_and_clean_batches(batches: Iterable[pd.DataFrame],
+                                metrics: Dict[str, Union[str, int]]) -> pd.DataFrame:
+    valid_batches = []
+    date_cache = {}
 
+    for batch in batches:
+        LOGGER.info(f'AWS lambda - FBL5N ETL - Processing batch of {len(batch)} rows')
+
+        valid_batches.append(filter_invalid_rows(structure_dataframe(batch, date_cache), metrics))
+
+    df = concat_dataframes(valid_batches)
+
+    return add_unique_key(filter_duplicated_rows(df)).reset_index(drop=True)
+
+
+def add_unique_key(df: pd.DataFrame) -> pd.DataFrame:
     conta = df['conta'].astype(int).astype(str)
     document_number = df['no_doc_'].astype(int).astype(str)
     item = df['itm'].astype(int).astype(str)
 
-    inside_df[TABLE_PRIMARY_KEY] = conta + '_' + document_number + '_' + item
+    df[TABLE_PRIMARY_KEY] = conta + '_' + document_number + '_' + item
 
-    return inside_df
+    return df
 
 
 def parse_record(record: map) -> Tuple[str, str, str]:
@@ -108,61 +213,183 @@ def parse_record(record: map) -> Tuple[str, str, str]:
     return bucket, key, state
 
 
-def parse_lines_to_dataframe(lines: List[str]) -> Union[pd.DataFrame, None]:
+def parse_lines_to_dataframe(lines: List[str]) -> pd.DataFrame:
     header = None
 
     for row in lines:
-        if row.startswith('|   St|'):
+        if row.startswith(HEADER_PREFIX):
             header = row
             break
 
     if not header:
         raise Exception('Failed to find header row in the file')
 
-    value_rows = [row.strip() for i, row in enumerate(lines) if row.startswith('| ') and not row.startswith('|   St|')]
+    value_rows = [row.strip() for i, row in enumerate(lines) if row.startswith('| ') and not row.startswith(HEADER_PREFIX)]
+
+    return parse_value_rows(header, value_rows)
+
+
+def parse_lines_to_batches(lines: Iterable[str], batch_size: int) -> Iterator[pd.DataFrame]:
+    header = None
+    value_rows = []
+    has_batches = False
+
+    for row in lines:
+        if row.startswith(HEADER_PREFIX):
+            header = header or row
+            continue
+
+        if row.startswith('| '):
+            value_rows.append(row.strip())
+
+        if header and len(value_rows) >= batch_size:
+            yield parse_value_rows(header, value_rows)
+            value_rows = []
+            has_batches = True
+
+    if not header:
+        raise Exception('Failed to find header row in the file')
+
+    if value_rows or not has_batches:
+        yield parse_value_rows(header, value_rows)
+
+
+def parse_value_rows(header: str, value_rows: List[str]) -> pd.DataFrame:
+    if PARSE_ENGINE == 'fixed_width':
+        return parse_fixed_width_rows(header, value_rows)
+
+    if PARSE_ENGINE == 'pyarrow':
+        return parse_arrow_rows(header, value_rows)
 
+    return parse_csv_rows(header, value_rows)
+
+
+def quote_text_column(header: str, value_rows: List[str]) -> None:
     text_index = header.find('Texto')
     final_pipe_index = text_index + header[text_index:].find('|')
 
     for i, row in enumerate(value_rows):
         value_rows[i] = row[:text_index] + '"' + row[text_index:final_pipe_index] + '"' + row[final_pipe_index:]
 
-    valid_rows = [header] + value_rows
 
-    if len(valid_rows) == 0:
-        return None
+def parse_csv_rows(header: str, value_rows: List[str]) -> pd.DataFrame:
+    quote_text_column(header, value_rows)
 
-    with io.StringIO('\n'.join(valid_rows)) as text_io:
-        df = pd.read_csv(text_io, sep='|', dtype={
-            'Nº ID fiscal 1': str,
-            'Nº doc.   ': str,
-            'DocCompens': str,
-            'Conta do Razão  ': str,
-            'ChvRefer 3   ': str
-        })
+    with io.StringIO('\n'.join([header] + value_rows)) as text_io:
+        df = pd.read_csv(text_io, sep='|', dtype={column: str for column in STRING_COLUMNS})
 
     return df.rename(str.strip, axis='columns')
 
 
-def structure_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+def parse_arrow_rows(header: str, value_rows: List[str]) -> pd.DataFrame:
+    df = parse_rows_to_table(header, value_rows).to_pandas()
+
+    convert_number_columns(df, [name.strip() for name in STRING_COLUMNS])
+
+    return df
+
+
+def parse_rows_to_table(header: str, value_rows: List[str]) -> pa.Table:
+    names = [name.strip() for name in parse_header_column_names(header)]
+    column_types = {name: pa.string() for name in names}
+
+    if not value_rows:
+        return pa.table({name: pa.array([], type=pa.string()) for name in names})
+
+    quote_text_column(header, value_rows)
+
+    with pa.BufferReader('\n'.join(value_rows).encode('utf-8')) as buffer:
+        return pa_csv.read_csv(
+            buffer,
+            read_options=pa_csv.ReadOptions(use_threads=True, block_size=ARROW_BLOCK_SIZE, column_names=names),
+            parse_options=pa_csv.ParseOptions(delimiter='|'),
+            convert_options=pa_csv.ConvertOptions(column_types=column_types, strings_can_be_null=True)
+        )
+
+
+def parse_fixed_width_rows(header: str, value_rows: List[str]) -> pd.DataFrame:
+    names = parse_header_column_names(header)
+    spans = parse_header_column_spans(header)
+    width = spans[-1][1]
+
+    misaligned_rows = sum(len(row) != width for row in value_rows)
+
+    if misaligned_rows:
+        LOGGER.warning(f'AWS lambda - FBL5N ETL - {misaligned_rows} rows do not match the header width of '
+                       f'{width} characters, falling back to the csv parse engine')
+        return parse_csv_rows(header, value_rows)
+
+    column_blocks = {name: [] for name in names}
+
+    for start in range(0, len(value_rows), FIXED_WIDTH_BLOCK_ROWS):
+        block = np.array(value_rows[start:start + FIXED_WIDTH_BLOCK_ROWS], dtype=f'<U{width}')
+        characters = block.view('<U1').reshape(-1, width)
+
+        for name, (column_start, column_end) in zip(names, spans):
+            column_blocks[name].append(slice_fixed_width_column(characters, column_start, column_end))
+
+    df = pd.DataFrame({
+        name: np.concatenate(blocks) if blocks else np.array([], dtype=object)
+        for name, blocks in column_blocks.items()
+    })
+
+    for name in names:
+        df[name] = df[name].where(df[name] != '')
+
+    convert_number_columns(df, STRING_COLUMNS)
+
+    return df.rename(str.strip, axis='columns')
+
+
+def convert_number_columns(df: pd.DataFrame, string_columns: List[str]) -> None:
+    for name in df.columns:
+        if name not in string_columns:
+            df[name] = pd.to_numeric(df[name], errors='ignore')
+
+
+def parse_header_column_names(header: str) -> List[str]:
+    with io.StringIO(header) as text_io:
+        return list(pd.read_csv(text_io, sep='|', nrows=0).columns)
+
+
+def parse_header_column_spans(header: str) -> List[Tuple[int, int]]:
+    pipe_indexes = [i for i, character in enumerate(header) if character == '|']
+
+    starts = [0] + [i + 1 for i in pipe_indexes]
+    ends = pipe_indexes + [len(header.rstrip())]
+
+    return list(zip(starts, ends))
+
+
+def slice_fixed_width_column(characters: np.ndarray, start: int, end: int) -> np.ndarray:
+    if end <= start:
+        return np.full(len(characters), '', dtype=object)
+
+    return np.ascontiguousarray(characters[:, start:end]).view(f'<U{end - start}').ravel().astype(object)
+
+
+def structure_dataframe(df: pd.DataFrame, date_cache: Dict[str, np.datetime64] = None) -> pd.DataFrame:
     LOGGER.info(f'AWS lambda - FBL5N ETL - Structuring DataFrame')
 
-    valid_rows_df = df.copy()
+    valid_rows_df = df
 
     columns = list(map(convert_column_name, valid_rows_df.columns))
 
     valid_rows_df.columns = columns
 
+    del valid_rows_df['unnamed__0']
+    del valid_rows_df['unnamed__31']
+
     for column in NUMBER_COLUMNS:
-        valid_rows_df[column] = valid_rows_df[column].astype(str) \
-            .str.strip() \
-            .str.replace('*', '') \
-            .apply(parse_sap_format_to_number)
+        if EXACT_MONEY and column in MONEY_COLUMNS:
+            valid_rows_df[column] = parse_sap_format_series_to_cents(valid_rows_df[column])
+        else:
+            valid_rows_df[column] = parse_sap_format_series_to_number(valid_rows_df[column])
+
+    date_cache = {} if date_cache is None else date_cache
 
     for column in DATE_COLUMNS:
-        valid_rows_df[column] = valid_rows_df[column].str.strip()
-        valid_rows_df[column] = valid_rows_df[column].apply(lambda x: None if x == '' else x)
-        valid_rows_df[column] = pd.to_datetime(valid_rows_df[column], format='%d.%m.%Y')
+        valid_rows_df[column] = parse_sap_format_series_to_date(valid_rows_df[column], '%d.%m.%Y', date_cache)
 
     valid_rows_df['no_id_fiscal_1'] = valid_rows_df['no_id_fiscal_1'].str.strip()
 
@@ -175,50 +402,90 @@ def structure_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     valid_rows_df['tipo_de_cliente'] = \
         valid_rows_df['no_id_fiscal_1'].apply(create_tipo_de_cliente_value)
 
-    return valid_rows_df.drop(['unnamed__0', 'unnamed__31'], axis='columns')
+    for column in CATEGORY_COLUMNS:
+        valid_rows_df[column] = valid_rows_df[column].astype('category')
+
+    return valid_rows_df
 
 
-def clean_dataframe(df: pd.DataFrame) -> pd.DataFrame:
+def clean_dataframe(df: pd.DataFrame, metrics: Dict[str, Union[str, int]] = None) -> pd.DataFrame:
     LOGGER.info('AWS lambda - FBL5N ETL - Cleaning Dataframe')
 
-    valid_rows_df = filter_conta_values(df)
-    valid_rows_df = filter_id_fiscal_values(valid_rows_df)
-    valid_rows_df = filter_mont_em_mi_values(valid_rows_df)
-    valid_rows_df = filter_texto_values(valid_rows_df)
-    valid_rows_df = filter_data_doc_venc_liquid_values(valid_rows_df)
-    valid_rows_df = filter_tipo_de_cliente_values(valid_rows_df)
-    valid_rows_df = add_unique_key(valid_rows_df)
+    valid_rows_df = filter_invalid_rows(df, metrics)
     valid_rows_df = filter_duplicated_rows(valid_rows_df)
+    valid_rows_df = add_unique_key(valid_rows_df)
 
     return valid_rows_df.reset_index(drop=True)
 
 
-def filter_conta_values(df: pd.DataFrame) -> pd.DataFrame:
-    return df[(df.conta > 9999) & (~df.conta.isna())]
+def filter_invalid_rows(df: pd.DataFrame, metrics: Dict[str, Union[str, int]] = None) -> pd.DataFrame:
+    masks = {
+        'conta': conta_values_mask(df),
+        'id_fiscal': id_fiscal_values_mask(df),
+        'mont_em_mi': mont_em_mi_values_mask(df),
+        'texto': texto_values_mask(df),
+        'data_doc_venc_liquid': data_doc_venc_liquid_values_mask(df),
+        'tipo_de_cliente': tipo_de_cliente_values_mask(df),
+    }
+
+    if metrics is not None:
+        for rule, mask in masks.items():
+            metric = f'rejected_rows_{rule}'
+            metrics[metric] = metrics.get(metric, 0) + int(len(mask) - np.count_nonzero(mask))
+
+    valid_rows_mask = np.logical_and.reduce(list(masks.values()))
+
+    return df.take(np.flatnonzero(valid_rows_mask))
+
+
+def conta_values_mask(df: pd.DataFrame) -> np.ndarray:
+    return ((df.conta > 9999) & (~df.conta.isna())).to_numpy()
+
 
+def id_fiscal_values_mask(df: pd.DataFrame) -> np.ndarray:
+    return (~df.no_id_fiscal_1.isna()).to_numpy()
 
-def filter_id_fiscal_values(df: pd.DataFrame) -> pd.DataFrame:
-    return df[~df.no_id_fiscal_1.isna()]
 
+def mont_em_mi_values_mask(df: pd.DataFrame) -> np.ndarray:
+    minimum_amount = MINIMUM_AMOUNT * 100 if EXACT_MONEY else MINIMUM_AMOUNT
 
-def filter_mont_em_mi_values(df: pd.DataFrame) -> pd.DataFrame:
-    return df[((df.mont_em_mi >= 10) | ((df.tip.isin(['Y4 ', 'X4 ', 'DZ '])) & (df.mont_em_mi < 0)))]
+    mask = (df.mont_em_mi >= minimum_amount) | ((df.tip.isin(['Y4 ', 'X4 ', 'DZ '])) & (df.mont_em_mi < 0))
 
+    return mask.fillna(False).to_numpy(dtype=bool)
 
-def filter_texto_values(df: pd.DataFrame) -> pd.DataFrame:
-    return df[~df.texto.str.lower().str.contains('deudor')]
 
+def texto_values_mask(df: pd.DataFrame) -> np.ndarray:
+    return (~df.texto.str.lower().str.contains('deudor', na=False)).to_numpy()
 
-def filter_data_doc_venc_liquid_values(df: pd.DataFrame) -> pd.DataFrame:
-    return df[df.vencliquid >= df.data_doc_]
 
+def data_doc_venc_liquid_values_mask(df: pd.DataFrame) -> np.ndarray:
+    return (df.vencliquid >= df.data_doc_).to_numpy()
 
-def filter_tipo_de_cliente_values(df: pd.DataFrame) -> pd.DataFrame:
-    return df[df.tipo_de_cliente == 'CNPJ']
+
+def tipo_de_cliente_values_mask(df: pd.DataFrame) -> np.ndarray:
+    return (df.tipo_de_cliente == 'CNPJ').to_numpy()
 
 
 def filter_duplicated_rows(df: pd.DataFrame) -> pd.DataFrame:
-    return df.sort_values('data_doc_', ascending=False).drop_duplicates(subset=[TABLE_PRIMARY_KEY])
+    key = create_composite_key(df)
+    dates = df['data_doc_'].to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+    latest_dates = pd.Series(dates).groupby(key, sort=False).transform('max').to_numpy()
+    latest_rows = np.flatnonzero(dates == latest_dates)
+
+    is_duplicated = pd.Series(key[latest_rows]).duplicated().to_numpy()
+
+    return df.take(latest_rows[~is_duplicated])
+
+
+def create_composite_key(df: pd.DataFrame) -> np.ndarray:
+    key = np.zeros(len(df), dtype=np.int64)
+
+    for values in (df['conta'].astype(int), df['no_doc_'].astype(int), df['itm'].astype(int)):
+        codes, uniques = pd.factorize(values)
+        key, _ = pd.factorize(key * len(uniques) + codes)
+
+    return key
 
 
 def convert_column_name(name: str) -> str:
@@ -231,33 +498,182 @@ def convert_column_name(name: str) -> str:
         .replace(':', '_')
 
 
-def insert_processed_dataframe_in_database(df: pd.DataFrame) -> None:
-    LOGGER.info(f'AWS lambda - FBL5N ETL - Structuring DataFrame')
+def insert_processed_dataframe_in_database(df: pd.DataFrame) -> Dict[str, int]:
+    LOGGER.info('AWS lambda - FBL5N ETL - Inserting DataFrame into the database')
+
+    source_rows_mask = merge_source_mask(df)
+    source_df = df.take(np.flatnonzero(source_rows_mask))
+
+    business_columns = [column for column in source_df.columns if column not in META_COLUMNS]
+    source_df[ROW_HASH_COLUMN] = create_row_hash(source_df, business_columns)
+
+    columns = tuple(source_df.columns)
+
+    with database_connection() as connection:
+        if MERGE_BATCH_ROWS > 0:
+            with transaction_scope(connection):
+                create_merge_progress_table(connection)
+                load_staging_table(connection, source_df)
+
+            inserted_rows, updated_rows = merge_staging_table_in_batches(
+                connection,
+                columns,
+                str(df['file_name'].iloc[0]) if len(df) else '',
+                int(source_df[ROW_HASH_COLUMN].to_numpy().sum())
+            )
+        else:
+            with transaction_scope(connection):
+                load_staging_table(connection, source_df)
+
+                inserted_rows, updated_rows = fetch_one(connection, create_merge_statement(columns))
+
+                execute_statement(connection, f'DROP TABLE {STAGING_TABLE_NAME}')
 
-    dummy_table = f'fbl5n_dummy_{create_unique_id()}'
+    LOGGER.info(f'AWS lambda - FBL5N ETL - Merged {inserted_rows} new and {updated_rows} changed rows')
 
-    insert_into_database(df, dummy_table, 'replace')
+    return {
+        'rejected_rows_merge_source': int(len(df) - len(source_df)),
+        'inserted_rows': inserted_rows,
+        'updated_rows': updated_rows,
+        'unchanged_rows': len(source_df) - inserted_rows - updated_rows,
+    }
 
-    query = f'''
+
+def create_merge_progress_table(connection) -> None:
+    execute_statement(connection, f'''
+        IF OBJECT_ID('{MERGE_PROGRESS_TABLE_NAME}') IS NULL
+            CREATE TABLE {MERGE_PROGRESS_TABLE_NAME} (
+                file_name NVARCHAR(255) NOT NULL PRIMARY KEY,
+                source_hash BIGINT NOT NULL,
+                last_key VARCHAR(64) NOT NULL,
+                inserted_rows BIGINT NOT NULL,
+                updated_rows BIGINT NOT NULL
+            )
+        ''')
+
+
+def load_staging_table(connection, df: pd.DataFrame) -> None:
+    execute_statement(connection, f"IF OBJECT_ID('tempdb..{STAGING_TABLE_NAME}') IS NOT NULL "
+                                  f"DROP TABLE {STAGING_TABLE_NAME}")
+
+    execute_statement(connection, create_table_statement(df, STAGING_TABLE_NAME, STAGING_COLUMN_TYPES))
+
+    bulk_insert_dataframe(connection, df, STAGING_TABLE_NAME)
+
+    execute_statement(connection, f'CREATE UNIQUE CLUSTERED INDEX ix_{TABLE_PRIMARY_KEY} '
+                                  f'ON {STAGING_TABLE_NAME} ({TABLE_PRIMARY_KEY})')
+
+
+def merge_staging_table_in_batches(connection,
+                                   columns: Tuple[str, ...],
+                                   file_name: str,
+                                   source_hash: int) -> Tuple[int, int]:
+    with transaction_scope(connection):
+        progress = fetch_one(connection,
+                             f'SELECT source_hash, last_key, inserted_rows, updated_rows '
+                             f'FROM {MERGE_PROGRESS_TABLE_NAME} WHERE file_name = %s',
+                             (file_name,))
+
+    if progress and progress[0] == source_hash:
+        _, last_key, inserted_rows, updated_rows = progress
+        LOGGER.info(f'AWS lambda - FBL5N ETL - Resuming MERGE of {file_name} after key {last_key}')
+    else:
+        last_key, inserted_rows, updated_rows = '', 0, 0
+
+    batch = 0
+
+    while True:
+        with transaction_scope(connection):
+            upper_key, = fetch_one(connection,
+                                   f'SELECT MAX({TABLE_PRIMARY_KEY}) FROM ('
+                                   f'SELECT TOP (%s) {TABLE_PRIMARY_KEY} FROM {STAGING_TABLE_NAME} '
+                                   f'WHERE {TABLE_PRIMARY_KEY} > %s ORDER BY {TABLE_PRIMARY_KEY}) AS batch',
+                                   (MERGE_BATCH_ROWS, last_key))
+
+            if upper_key is None:
+                break
+
+            batch += 1
+            LOGGER.info(f'AWS lambda - FBL5N ETL - Merging batch {batch} up to key {upper_key}')
+
+            batch_inserted_rows, batch_updated_rows = fetch_one(connection,
+                                                                create_batch_merge_statement(columns),
+                                                                (last_key, upper_key))
+
+            inserted_rows += batch_inserted_rows
+            updated_rows += batch_updated_rows
+            last_key = upper_key
+
+            execute_statement(connection, f'''
+                UPDATE {MERGE_PROGRESS_TABLE_NAME}
+                SET source_hash = %s, last_key = %s, inserted_rows = %s, updated_rows = %s
+                WHERE file_name = %s
+
+                IF @@ROWCOUNT = 0
+                    INSERT INTO {MERGE_PROGRESS_TABLE_NAME}
+                        (source_hash, last_key, inserted_rows, updated_rows, file_name)
+                    VALUES (%s, %s, %s, %s, %s)
+                ''', (source_hash, last_key, inserted_rows, updated_rows, file_name) * 2)
+
+    with transaction_scope(connection):
+        execute_statement(connection, f'DELETE FROM {MERGE_PROGRESS_TABLE_NAME} WHERE file_name = %s', (file_name,))
+        execute_statement(connection, f'DROP TABLE {STAGING_TABLE_NAME}')
+
+    return inserted_rows, updated_rows
+
+
+@lru_cache(maxsize=None)
+def create_merge_statement(columns: Tuple[str, ...], source: str = STAGING_TABLE_NAME) -> str:
+    return f'''
      BEGIN        
-         MERGE {DATABASE_TABLE_NAME} AS target USING (
-             SELECT * FROM {dummy_table} 
-             WHERE 
-                 doccompens is null
-                 or cast(doccompens as varchar) not like '9%'
-                 or (rtrim(tip) in ('Y4','X4', 'DZ') and mont_em_mi < 0)
-         ) AS source
+         SET NOCOUNT ON;
+
+         DECLARE @changes TABLE (change_action NVARCHAR(10));
+
+         MERGE {DATABASE_TABLE_NAME} AS target USING {source} AS source
              ON 
                  target.key_unique_fbl5n = source.key_unique_fbl5n
          WHEN MATCHED AND source.file_date >= target.file_date
-             THEN UPDATE SET {','.join([f'target.{column} = source.{column}' for column in df.columns
+                 AND (target.{ROW_HASH_COLUMN} IS NULL OR target.{ROW_HASH_COLUMN} <> source.{ROW_HASH_COLUMN})
+             THEN UPDATE SET {','.join([f'target.{column} = {merge_source_value(column)}' for column in columns
                                         if column != TABLE_PRIMARY_KEY])} 
          WHEN NOT MATCHED
-             THEN INSERT ({','.join(df.columns)})
-             VALUES ({','.join([f'source.{column}' for column in df.columns])});
-
-         DROP TABLE {dummy_table};
+             THEN INSERT ({','.join(columns)})
+             VALUES ({','.join([merge_source_value(column) for column in columns])})
+         OUTPUT $action INTO @changes;
+
+         SELECT
+             COUNT(CASE WHEN change_action = 'INSERT' THEN 1 END),
+             COUNT(CASE WHEN change_action = 'UPDATE' THEN 1 END)
+         FROM @changes;
      END
      '''
 
-    execute_query(query)
+
+@lru_cache(maxsize=None)
+def create_batch_merge_statement(columns: Tuple[str, ...]) -> str:
+    statement = create_merge_statement(columns,
+                                       f'(SELECT * FROM {STAGING_TABLE_NAME} '
+                                       f'WHERE {TABLE_PRIMARY_KEY} > @lower_key '
+                                       f'AND {TABLE_PRIMARY_KEY} <= @upper_key)')
+
+    return f"EXEC sp_executesql N'{statement.replace(chr(39), chr(39) * 2)}', " \
+           f"N'@lower_key VARCHAR(64), @upper_key VARCHAR(64)', @lower_key = %s, @upper_key = %s"
+
+
+def merge_source_mask(df: pd.DataFrame) -> np.ndarray:
+    doccompens = df.doccompens.dropna()
+
+    is_clearing_document = doccompens.astype('int64').astype(str).str.startswith('9') \
+        .reindex(df.index, fill_value=False)
+
+    is_credit = df.tip.str.rstrip().isin(['Y4', 'X4', 'DZ']) & (df.mont_em_mi < 0)
+
+    return (~is_clearing_document | is_credit).fillna(False).to_numpy(dtype=bool)
+
+
+def merge_source_value(column: str) -> str:
+    if EXACT_MONEY and column in MONEY_COLUMNS:
+        return f'CAST(source.{column} * 0.01 AS DECIMAL(19, 2))'
+
+    return f'source.{column}'
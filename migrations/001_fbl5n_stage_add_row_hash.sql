@@ -0,0 +1,4 @@
+-- Adds the row content hash used by the FBL5N ETL MERGE to skip unchanged rows.
+-- Run once against the FBL5N database before deploying the ETL; safe to re-run.
+IF COL_LENGTH('fbl5n_stage', 'row_hash') IS NULL
+    ALTER TABLE fbl5n_stage ADD row_hash BIGINT NULL;
@@ -1,60 +1,334 @@
 import logging
 import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import create_engine, text
-from sqlalchemy.engine import Engine
+import pyarrow as pa
+import pymssql
+from pandas.api.types import is_bool_dtype, is_categorical_dtype, is_datetime64_any_dtype, is_float_dtype, \
+    is_integer_dtype, infer_dtype
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
+SQL_SERVER_MAX_INSERT_ROWS = 1000
+SQL_SERVER_MAX_NVARCHAR_LENGTH = 4000
+MINIMUM_NVARCHAR_LENGTH = 16
+CHARACTER_TYPE_PATTERN = re.compile(r'^(N?(?:VAR)?CHAR\([^)]*\))(.*)$', re.IGNORECASE)
 
-def create_database_connection() -> Engine:
+_ENGINE = None
+
+
+class PooledConnection:
+    def __init__(self, pool: 'ConnectionPool', connection, created_at: float):
+        self._pool = pool
+        self._connection = connection
+        self.created_at = created_at
+
+    def cursor(self):
+        return self._connection.cursor()
+
+    def commit(self) -> None:
+        self._connection.commit()
+
+    def rollback(self) -> None:
+        self._connection.rollback()
+
+    def close(self) -> None:
+        if self._connection is not None:
+            self._pool.release(self._connection, self.created_at)
+            self._connection = None
+
+
+class ConnectionPool:
+    def __init__(self, connect: Callable, size: int, recycle_seconds: int):
+        self._connect = connect
+        self._size = size
+        self._recycle_seconds = recycle_seconds
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def raw_connection(self) -> PooledConnection:
+        while True:
+            with self._lock:
+                connection, created_at = self._idle.pop() if self._idle else (None, None)
+
+            if connection is None:
+                return PooledConnection(self, self._connect(), time.monotonic())
+
+            if time.monotonic() - created_at < self._recycle_seconds and ping_connection(connection):
+                return PooledConnection(self, connection, created_at)
+
+            LOGGER.info('SQL Database - Discarding stale pooled connection')
+            close_quietly(connection)
+
+    def release(self, connection, created_at: float) -> None:
+        try:
+            connection.rollback()
+        except pymssql.Error:
+            close_quietly(connection)
+            return
+
+        with self._lock:
+            if len(self._idle) < self._size:
+                self._idle.append((connection, created_at))
+                return
+
+        close_quietly(connection)
+
+    def dispose(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+
+        for connection, _ in idle:
+            close_quietly(connection)
+
+
+def ping_connection(connection) -> bool:
+    try:
+        cursor = connection.cursor()
+        cursor.execute('SELECT 1')
+        cursor.fetchall()
+
+        return True
+    except pymssql.Error:
+        return False
+
+
+def close_quietly(connection) -> None:
+    try:
+        connection.close()
+    except pymssql.Error:
+        pass
+
+
+def create_database_connection() -> ConnectionPool:
     server = os.environ['DATABASE_SERVER']
     user = os.environ['DATABASE_USER']
     password = os.environ['DATABASE_PASSWORD']
     port = os.environ['DATABASE_PORT']
     database = os.environ['DATABASE_NAME']
 
-    url = f'mssql+pymssql://{user}:{password}@{server}:{port}/{database}'
+    def connect():
+        return pymssql.connect(server=server, user=user, password=password, database=database, port=port)
 
-    return create_engine(url)
+    return ConnectionPool(connect,
+                          int(os.environ.get('DATABASE_POOL_SIZE', '2')),
+                          int(os.environ.get('DATABASE_POOL_RECYCLE_SECONDS', '1800')))
 
 
-def insert_into_database(df: pd.DataFrame, table: str, if_exists='append', engine_func=create_database_connection):
+def get_database_engine() -> ConnectionPool:
+    global _ENGINE
+
+    if _ENGINE is None:
+        LOGGER.info('SQL Database - Creating database connection pool')
+        _ENGINE = create_database_connection()
+
+    return _ENGINE
+
+
+def reset_database_engine() -> None:
+    global _ENGINE
+
+    if _ENGINE is not None:
+        LOGGER.info('SQL Database - Disposing database connection pool')
+        _ENGINE.dispose()
+
+    _ENGINE = None
+
+
+def insert_into_database(df: pd.DataFrame, table: str, if_exists='append', engine_func=get_database_engine):
     LOGGER.info(f'SQL Database - Inserting data into "{table}"')
-    engine = engine_func()
 
     try:
-        df.to_sql(table, engine, if_exists=if_exists, index=False)
+        with database_transaction(engine_func) as connection:
+            if if_exists == 'replace':
+                execute_statement(connection, f"IF OBJECT_ID('{table}') IS NOT NULL DROP TABLE {table}")
+
+            if if_exists == 'fail':
+                execute_statement(connection, create_table_statement(df, table))
+            else:
+                execute_statement(connection, f"IF OBJECT_ID('{table}') IS NULL {create_table_statement(df, table)}")
+
+            bulk_insert_dataframe(connection, df, table)
+
         LOGGER.info(f'SQL Database - Data inserted into "{table}"')
 
     except Exception as ex:
         LOGGER.error(f'SQL Database - Failed to insert data into the database {ex}')
         raise ex
+
+
+@contextmanager
+def database_connection(engine_func=get_database_engine) -> Iterator:
+    connection = engine_func().raw_connection()
+
+    try:
+        yield connection
     finally:
-        engine.dispose()
+        connection.close()
+
+
+@contextmanager
+def transaction_scope(connection) -> Iterator:
+    try:
+        yield connection
+        connection.commit()
+    except Exception as ex:
+        LOGGER.error(f'SQL Database - Transaction rolled back: {ex}')
+        connection.rollback()
+        raise ex
+
+
+@contextmanager
+def database_transaction(engine_func=get_database_engine) -> Iterator:
+    with database_connection(engine_func) as connection, transaction_scope(connection):
+        yield connection
+
+
+def execute_statement(connection, query: str, parameters: tuple = None) -> None:
+    connection.cursor().execute(query, parameters)
+
 
+def fetch_one(connection, query: str, parameters: tuple = None) -> tuple:
+    cursor = connection.cursor()
+    cursor.execute(query, parameters)
 
-def get_dataframe_from_database(query: str) -> pd.DataFrame:
-    engine = create_database_connection()
+    return cursor.fetchone()
 
+
+def fetch_all(connection, query: str, parameters: tuple = None) -> Tuple[List[str], List[tuple]]:
+    cursor = connection.cursor()
+    cursor.execute(query, parameters)
+
+    return [column[0] for column in cursor.description], cursor.fetchall()
+
+
+def create_table_statement(df: pd.DataFrame, table: str, column_types: Dict[str, str] = None) -> str:
+    column_types = column_types or {}
+
+    definitions = []
+
+    for column in df.columns:
+        sql_type = column_types.get(column) or infer_sql_type(df[column])
+
+        if table.startswith('#'):
+            sql_type = CHARACTER_TYPE_PATTERN.sub(r'\1 COLLATE DATABASE_DEFAULT\2', sql_type)
+
+        definitions.append(f'{column} {sql_type}')
+
+    return f'CREATE TABLE {table} ({", ".join(definitions)})'
+
+
+def infer_sql_type(series: pd.Series) -> str:
+    dtype = series.dtype.categories.dtype if is_categorical_dtype(series.dtype) else series.dtype
+
+    if is_bool_dtype(dtype):
+        return 'BIT'
+
+    if is_integer_dtype(dtype):
+        return 'BIGINT'
+
+    if is_float_dtype(dtype):
+        return 'FLOAT'
+
+    if is_datetime64_any_dtype(dtype):
+        return 'DATETIME2'
+
+    inferred_type = infer_dtype(series.cat.categories if is_categorical_dtype(series.dtype) else series, skipna=True)
+
+    if inferred_type == 'date':
+        return 'DATE'
+
+    if inferred_type == 'datetime':
+        return 'DATETIME2'
+
+    if inferred_type in ('string', 'empty'):
+        return bounded_nvarchar_type(series)
+
+    return 'NVARCHAR(MAX)'
+
+
+def bounded_nvarchar_type(series: pd.Series) -> str:
+    values = series.cat.categories.to_series() if is_categorical_dtype(series.dtype) else series
+    max_length = values.str.len().max()
+
+    length = MINIMUM_NVARCHAR_LENGTH
+
+    while length < (0 if pd.isna(max_length) else max_length):
+        length *= 2
+
+    return f'NVARCHAR({length})' if length <= SQL_SERVER_MAX_NVARCHAR_LENGTH else 'NVARCHAR(MAX)'
+
+
+def bulk_insert_dataframe(connection, df: pd.DataFrame, table: str) -> None:
+    columns = list(df.columns)
+    batch_rows = SQL_SERVER_MAX_INSERT_ROWS
+
+    row_placeholder = f'({", ".join(["%s"] * len(columns))})'
+    column_values = [column_to_python_values(df[column]) for column in columns]
+
+    cursor = connection.cursor()
+
+    for start in range(0, len(df), batch_rows):
+        stop = min(start + batch_rows, len(df))
+
+        parameters = np.empty((stop - start, len(columns)), dtype=object)
+
+        for i, values in enumerate(column_values):
+            parameters[:, i] = values[start:stop]
+
+        query = f'INSERT INTO {table} ({", ".join(columns)}) VALUES {", ".join([row_placeholder] * (stop - start))}'
+
+        cursor.execute(query, tuple(parameters.ravel().tolist()))
+
+    LOGGER.info(f'SQL Database - {len(df)} rows inserted into "{table}" in batches of {batch_rows} rows')
+
+
+def column_to_python_values(series: pd.Series) -> np.ndarray:
+    if is_datetime64_any_dtype(series):
+        values = series.dt.to_pydatetime()
+    else:
+        values = series.astype(object).to_numpy()
+
+    values[series.isna().to_numpy()] = None
+
+    return values
+
+
+def get_dataframe_from_database(query: str, engine_func=get_database_engine) -> pd.DataFrame:
     try:
-        return pd.read_sql(query, engine)
+        with database_connection(engine_func) as connection:
+            columns, rows = fetch_all(connection, query)
+
+        return pd.DataFrame.from_records(rows, columns=columns)
     except Exception as ex:
         LOGGER.error(f'Failed to get data from the database {ex}')
         raise ex
-    finally:
-        engine.dispose()
 
 
-def execute_query(query: str, engine_func=create_database_connection) -> None:
-    engine = engine_func()
+def get_table_from_database(query: str, engine_func=get_database_engine) -> pa.Table:
+    try:
+        with database_connection(engine_func) as connection:
+            columns, rows = fetch_all(connection, query)
+
+        values = list(zip(*rows)) or [()] * len(columns)
+
+        return pa.Table.from_arrays([pa.array(column_values) for column_values in values], names=columns)
+    except Exception as ex:
+        LOGGER.error(f'Failed to get data from the database {ex}')
+        raise ex
+
 
+def execute_query(query: str, engine_func=get_database_engine) -> None:
     try:
-        engine.execute(text(query).execution_options(autocommit=True))
+        with database_transaction(engine_func) as connection:
+            execute_statement(connection, query)
     except Exception as ex:
         LOGGER.error(f'Failed to execute query {query}: {ex}')
         raise ex
-    finally:
-        engine.dispose()
@@ -1,21 +1,51 @@
+import codecs
+import hashlib
 import io
+import itertools
+import json
 import logging
 import re
 import string
+import zipfile
+import zlib
 from datetime import datetime, date
-from typing import Union, Tuple
+from typing import Callable, Dict, Union, Tuple, Iterator, Iterable, List, Optional
+import chardet
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pandas.api.types import is_categorical_dtype, union_categoricals
 import sys
 import pathlib
 import random
 
 sys.path.append(str(pathlib.Path(__file__).parent.absolute()))
 
-from s3 import get_file_from_s3, send_file_to_s3, copy_object_in_s3, delete_file_from_s3
+from s3 import get_s3_client, get_file_from_s3, get_file_stream_from_s3, get_file_ranges_from_s3, \
+    get_object_metadata_from_s3, object_exists_in_s3, send_file_to_s3, copy_object_in_s3, delete_file_from_s3, \
+    S3MultipartWriter
 
 LOGGER = logging.getLogger()
 LOGGER.setLevel(logging.INFO)
 
+STREAM_CHUNK_SIZE = 1024 * 1024
+PARQUET_ROW_GROUP_ROWS = 128 * 1024
+
+COMPRESSION_MAGIC_SIZE = 4
+GZIP_MAGIC = b'\x1f\x8b'
+ZIP_MAGIC = b'PK\x03\x04'
+
+ENCODING_SNIFF_SIZE = 64 * 1024
+ENCODING_MIN_CONFIDENCE = 0.5
+DEFAULT_ENCODING = 'iso-8859-1'
+MARKER_ENCODINGS = ['utf-8', 'iso-8859-1']
+BYTE_ORDER_MARKS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
 
 def read_file(s3_client, bucket: str, key: str) -> bytes:
     LOGGER.info(f'AWS lambda - Reading File of {bucket} in {key}')
@@ -23,12 +53,223 @@ def read_file(s3_client, bucket: str, key: str) -> bytes:
     return get_file_from_s3(s3_client, bucket, key)
 
 
-def create_parquet_and_send_to_s3(s3_client, bucket: str, key: str, df: pd.DataFrame):
+def read_file_stream(s3_client, bucket: str, key: str, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[bytes]:
+    LOGGER.info(f'AWS lambda - Streaming File of {bucket} in {key}')
+
+    return get_file_stream_from_s3(s3_client, bucket, key, chunk_size)
+
+
+def read_file_ranges(s3_client, bucket: str, key: str, part_size: int) -> Iterator[memoryview]:
+    LOGGER.info(f'AWS lambda - Reading File of {bucket} in {key} in ranges of {part_size} bytes')
+
+    return get_file_ranges_from_s3(s3_client, bucket, key, part_size)
+
+
+def iter_bytes_chunks(data: bytes, chunk_size: int = STREAM_CHUNK_SIZE) -> Iterator[memoryview]:
+    view = memoryview(data)
+
+    for start in range(0, len(view), chunk_size):
+        yield view[start:start + chunk_size]
+
+
+def detect_compression(prefix: bytes) -> Optional[str]:
+    if prefix.startswith(GZIP_MAGIC):
+        return 'gzip'
+
+    if prefix.startswith(ZIP_MAGIC):
+        return 'zip'
+
+    return None
+
+
+def decompress_chunks(chunks: Iterable[bytes]) -> Tuple[Optional[str], Iterator[bytes]]:
+    chunks = iter(chunks)
+    prefix_chunks = []
+    prefix_size = 0
+
+    for chunk in chunks:
+        prefix_chunks.append(chunk)
+        prefix_size += len(chunk)
+
+        if prefix_size >= COMPRESSION_MAGIC_SIZE:
+            break
+
+    compression = detect_compression(b''.join(prefix_chunks)[:COMPRESSION_MAGIC_SIZE])
+    chunks = itertools.chain(prefix_chunks, chunks)
+
+    if compression == 'gzip':
+        return compression, decompress_gzip_chunks(chunks)
+
+    if compression == 'zip':
+        return compression, decompress_zip_chunks(chunks)
+
+    return compression, chunks
+
+
+def decompress_gzip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        while chunk:
+            if decompressor.eof:
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+            yield decompressor.decompress(chunk)
+
+            chunk = decompressor.unused_data
+
+    yield decompressor.flush()
+
+    if not decompressor.eof:
+        raise Exception('Failed to decompress gzip file: the file is truncated or corrupt')
+
+
+def decompress_zip_chunks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    with zipfile.ZipFile(io.BytesIO(b''.join(chunks))) as archive:
+        members = [member for member in archive.infolist() if not member.is_dir()]
+
+        if not members:
+            raise Exception('Failed to decompress zip file: the archive is empty')
+
+        with archive.open(members[0]) as file:
+            while True:
+                data = file.read(STREAM_CHUNK_SIZE)
+
+                if not data:
+                    break
+
+                yield data
+
+
+def detect_encoding(prefix: bytes, markers: Iterable[str] = ()) -> str:
+    for byte_order_mark, encoding in BYTE_ORDER_MARKS:
+        if prefix.startswith(byte_order_mark):
+            return encoding
+
+    for marker in markers:
+        for encoding in MARKER_ENCODINGS:
+            if marker.encode(encoding) in prefix:
+                return encoding
+
+    detection = chardet.detect(prefix)
+
+    if not detection['encoding'] or detection['encoding'] == 'ascii' \
+            or detection['confidence'] < ENCODING_MIN_CONFIDENCE:
+        return DEFAULT_ENCODING
+
+    return codecs.lookup(detection['encoding']).name
+
+
+def sniff_encoding(chunks: Iterable[bytes], markers: Iterable[str] = ()) -> Tuple[str, Iterator[bytes]]:
+    chunks = iter(chunks)
+    prefix_chunks = []
+    prefix_size = 0
+
+    for chunk in chunks:
+        prefix_chunks.append(chunk)
+        prefix_size += len(chunk)
+
+        if prefix_size >= ENCODING_SNIFF_SIZE:
+            break
+
+    prefix = b''.join(prefix_chunks)[:ENCODING_SNIFF_SIZE]
+
+    return detect_encoding(prefix, markers), itertools.chain(prefix_chunks, chunks)
+
+
+def decode_chunks(chunks: Iterable[bytes], encoding: str) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder(encoding)()
+
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+
+    yield decoder.decode(b'', final=True)
+
+
+def split_lines(chunks: Iterable[str]) -> Iterator[str]:
+    remainder = ''
+
+    for chunk in chunks:
+        lines = (remainder + chunk).split('\n')
+        remainder = lines.pop()
+
+        yield from lines
+
+    yield remainder
+
+
+def create_parquet_and_send_to_s3(s3_client,
+                                  bucket: str,
+                                  key: str,
+                                  df: pd.DataFrame,
+                                  decimal_columns: Optional[List[str]] = None,
+                                  before_complete: Optional[Callable[[], None]] = None):
     LOGGER.info(f'AWS lambda - Creating and Uploading Parquet File to {key}')
 
-    with io.BytesIO() as buffer:
-        df.to_parquet(buffer, index=False)
-        send_file_to_s3(s3_client, bucket, key, buffer)
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    writer = None
+
+    with S3MultipartWriter(s3_client, bucket, key, before_complete=before_complete) as sink:
+        for start in range(0, max(len(df), 1), PARQUET_ROW_GROUP_ROWS):
+            table = dataframe_to_arrow(df.iloc[start:start + PARQUET_ROW_GROUP_ROWS], decimal_columns, schema)
+
+            if writer is None:
+                writer = pq.ParquetWriter(sink, table.schema, use_dictionary=True)
+
+            writer.write_table(table)
+
+        writer.close()
+
+
+def dataframe_to_arrow(df: pd.DataFrame,
+                       decimal_columns: Optional[List[str]] = None,
+                       schema: Optional[pa.Schema] = None) -> pa.Table:
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+
+    for column in decimal_columns or []:
+        index = table.schema.get_field_index(column)
+        table = table.set_column(index, column, cents_to_decimal_array(table.column(column)))
+
+    if decimal_columns:
+        table = table.replace_schema_metadata(decimal_pandas_metadata(table.schema, decimal_columns))
+
+    return table
+
+
+def decimal_pandas_metadata(schema: pa.Schema, decimal_columns: List[str]) -> Dict[bytes, bytes]:
+    metadata = dict(schema.metadata or {})
+    pandas_metadata = json.loads(metadata[b'pandas'])
+
+    for column in pandas_metadata['columns']:
+        if column['name'] in decimal_columns:
+            decimal_type = schema.field(column['name']).type
+
+            column['pandas_type'] = 'decimal'
+            column['numpy_type'] = 'object'
+            column['metadata'] = {'precision': decimal_type.precision, 'scale': decimal_type.scale}
+
+    metadata[b'pandas'] = json.dumps(pandas_metadata).encode('utf-8')
+
+    return metadata
+
+
+def cents_to_decimal_array(cents: pa.ChunkedArray, precision: int = 18) -> pa.ChunkedArray:
+    decimal_type = pa.decimal128(precision, 2)
+    chunks = []
+
+    for chunk in cents.chunks:
+        validity, data = chunk.buffers()
+
+        low_words = np.frombuffer(data, dtype=np.int64)[:chunk.offset + len(chunk)]
+        words = np.column_stack([low_words, low_words >> 63])
+
+        chunks.append(pa.Array.from_buffers(decimal_type,
+                                            len(chunk),
+                                            [validity, pa.py_buffer(words.tobytes())],
+                                            chunk.null_count,
+                                            chunk.offset))
+
+    return pa.chunked_array(chunks, type=decimal_type)
 
 
 def create_parquet_key(file_date: date,
@@ -57,6 +298,55 @@ def parse_sap_format_to_number(number: str) -> Union[float, None]:
     return float(number_converted)
 
 
+def parse_sap_format_series_to_number(series: pd.Series) -> pd.Series:
+    numbers = series.astype(str).str.strip().str.replace('*', '', regex=False)
+
+    is_negative = numbers.str.endswith('-').to_numpy()
+    numbers = numbers.where(~is_negative, numbers.str[:-1])
+    numbers = numbers.str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+    numbers = numbers.where(numbers != '', 'nan')
+
+    values = numbers.to_numpy(dtype=object).astype(np.float64)
+
+    return pd.Series(np.where(is_negative, -values, values), index=series.index)
+
+
+def parse_sap_format_series_to_cents(series: pd.Series) -> pd.Series:
+    numbers = series.astype(str).str.strip().str.replace('*', '', regex=False)
+
+    is_negative = numbers.str.endswith('-').to_numpy()
+    numbers = numbers.where(~is_negative, numbers.str[:-1]).str.replace('.', '', regex=False)
+    is_empty = (series.isna() | (numbers == '')).to_numpy()
+
+    parts = numbers.str.partition(',')
+    integers, fractions = parts[0], parts[2]
+
+    if (fractions.str.len() > 2).any() and fractions.str[2:].str.strip('0').str.len().any():
+        raise Exception('Failed to convert amount to cents: more than 2 decimal places found')
+
+    cents = (integers + fractions.str[:2].str.ljust(2, '0')).where(~is_empty, '0')
+    values = cents.to_numpy(dtype=object).astype(np.int64)
+
+    return pd.Series(pd.arrays.IntegerArray(np.where(is_negative, -values, values), is_empty), index=series.index)
+
+
+def parse_sap_format_series_to_date(series: pd.Series,
+                                    date_format: str,
+                                    cache: Dict[str, np.datetime64]) -> pd.Series:
+    codes, uniques = pd.factorize(series)
+    dates = [str(value).strip() for value in uniques]
+
+    missing_dates = [value for value in set(dates) if value not in cache]
+
+    if missing_dates:
+        parsed_dates = pd.to_datetime([value or None for value in missing_dates], format=date_format)
+        cache.update(zip(missing_dates, parsed_dates.to_numpy()))
+
+    values = np.array([cache[value] for value in dates] + [np.datetime64('NaT')], dtype='datetime64[ns]')
+
+    return pd.Series(values[codes], index=series.index)
+
+
 def move_file_to_final_state(s3_client,
                              bucket: str,
                              system_name: str,
@@ -72,6 +362,38 @@ def move_file_to_final_state(s3_client,
     delete_file_from_s3(s3_client, bucket, key)
 
 
+def create_manifest_key(s3_client,
+                        record: map,
+                        system_name: str,
+                        database: str) -> str:
+    bucket = str(record['s3']['bucket']['name'])
+    key = str(record['s3']['object']['key'])
+    etag = record['s3']['object'].get('eTag')
+    size = record['s3']['object'].get('size')
+
+    if etag is None or size is None:
+        metadata = get_object_metadata_from_s3(s3_client, bucket, key)
+        etag, size = metadata['ETag'], metadata['ContentLength']
+
+    etag = str(etag).strip('"')
+    fingerprint = hashlib.sha1(f'{bucket}/{key}/{etag}/{size}'.encode('utf-8')).hexdigest()
+
+    return f'manifest/{system_name}/{database}/{fingerprint}.json'
+
+
+def is_file_processed(s3_client, bucket: str, manifest_key: str) -> bool:
+    return object_exists_in_s3(s3_client, bucket, manifest_key)
+
+
+def mark_file_processed(s3_client, bucket: str, manifest_key: str, key: str, metrics: Dict) -> None:
+    LOGGER.info(f'AWS lambda - Writing processed manifest "{manifest_key}" for "{key}"')
+
+    manifest = {'key': key, 'processing_date': datetime.now().isoformat(), 'metrics': metrics}
+
+    with io.BytesIO(json.dumps(manifest, default=str).encode('utf-8')) as buffer:
+        send_file_to_s3(s3_client, bucket, manifest_key, buffer)
+
+
 def parse_record(record: map) -> Tuple[str, str]:
     bucket = str(record['s3']['bucket']['name'])
     key = str(record['s3']['object']['key'])
@@ -91,14 +413,35 @@ def add_meta_columns(df: pd.DataFrame, key: str) -> pd.DataFrame:
 
     file_date = datetime.strptime(date_text, '%d_%m_%Y')
 
-    local_df = df.copy()
-    local_df['file_name'] = file_name
+    local_df = df
+    local_df['file_name'] = pd.Series(file_name, index=local_df.index, dtype='category')
     local_df['file_date'] = file_date
     local_df['processing_date'] = datetime.today().date()
 
     return local_df
 
 
+def create_row_hash(df: pd.DataFrame, columns: List[str]) -> np.ndarray:
+    return pd.util.hash_pandas_object(df[columns], index=False).to_numpy().view(np.int64)
+
+
+def concat_dataframes(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    df = pd.concat(frames, ignore_index=True)
+
+    for column in frames[0].columns:
+        if not is_categorical_dtype(frames[0][column]):
+            continue
+
+        categories_dtypes = {frame[column].cat.categories.dtype for frame in frames}
+
+        if len(categories_dtypes) == 1:
+            df[column] = pd.Series(union_categoricals([frame[column] for frame in frames]), index=df.index)
+        else:
+            df[column] = df[column].astype('category')
+
+    return df
+
+
 def create_unique_id() -> str:
     return ''.join(random.sample(string.ascii_lowercase + string.digits, 15))
 
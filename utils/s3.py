@@ -1,5 +1,42 @@
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO, StringIO
-from typing import Union
+from typing import Callable, Iterator, Optional, Union
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+LOGGER = logging.getLogger()
+LOGGER.setLevel(logging.INFO)
+
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+MULTIPART_MAX_WORKERS = 4
+RANGED_READ_MAX_WORKERS = 8
+NOT_FOUND_ERROR_CODES = ['404', 'NoSuchKey', 'NotFound']
+
+_S3_CLIENT = None
+
+
+def create_s3_client():
+    config = Config(max_pool_connections=int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '16')))
+
+    return boto3.client(
+        's3',
+        endpoint_url=os.environ['S3_ENDPOINT_URL'],
+        config=config
+    )
+
+
+def get_s3_client():
+    global _S3_CLIENT
+
+    if _S3_CLIENT is None:
+        LOGGER.info('AWS S3 - Creating S3 client')
+        _S3_CLIENT = create_s3_client()
+
+    return _S3_CLIENT
 
 
 def get_file_from_s3(s3_client, bucket: str, key: str) -> bytes:
@@ -11,14 +48,207 @@ def get_file_from_s3(s3_client, bucket: str, key: str) -> bytes:
     return response['Body'].read()
 
 
+def get_file_stream_from_s3(s3_client, bucket: str, key: str, chunk_size: int) -> Iterator[bytes]:
+    response = s3_client.get_object(
+        Bucket=bucket,
+        Key=key
+    )
+
+    return response['Body'].iter_chunks(chunk_size)
+
+
+def get_file_ranges_from_s3(s3_client,
+                            bucket: str,
+                            key: str,
+                            part_size: int,
+                            max_workers: int = RANGED_READ_MAX_WORKERS) -> Iterator[memoryview]:
+    response = s3_client.head_object(
+        Bucket=bucket,
+        Key=key
+    )
+
+    size = response['ContentLength']
+    view = memoryview(bytearray(size))
+
+    def get_range(start: int) -> memoryview:
+        stop = min(start + part_size, size)
+
+        range_response = s3_client.get_object(
+            Bucket=bucket,
+            Key=key,
+            Range=f'bytes={start}-{stop - 1}',
+            IfMatch=response['ETag']
+        )
+
+        view[start:stop] = range_response['Body'].read()
+
+        return view[start:stop]
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(get_range, start) for start in range(0, size, part_size)]
+
+        for future in futures:
+            yield future.result()
+
+
 def send_file_to_s3(s3_client, bucket: str, key: str, buffer: Union[BytesIO, StringIO]) -> None:
+    if isinstance(buffer, BytesIO):
+        buffer.seek(0)
+        body = buffer
+    else:
+        body = buffer.getvalue()
+
     s3_client.put_object(
         Bucket=bucket,
         Key=key,
-        Body=buffer.getvalue()
+        Body=body
+    )
+
+
+class S3MultipartWriter:
+    def __init__(self,
+                 s3_client,
+                 bucket: str,
+                 key: str,
+                 part_size: int = MULTIPART_PART_SIZE,
+                 max_workers: int = MULTIPART_MAX_WORKERS,
+                 before_complete: Optional[Callable[[], None]] = None):
+        self._s3_client = s3_client
+        self._bucket = bucket
+        self._key = key
+        self._part_size = part_size
+        self._max_workers = max_workers
+        self._before_complete = before_complete
+        self._buffer = bytearray()
+        self._position = 0
+        self._upload_id = None
+        self._executor = None
+        self._parts = []
+        self.closed = False
+
+    def __enter__(self) -> 'S3MultipartWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self) -> None:
+        pass
+
+    def write(self, data) -> int:
+        size = len(data)
+
+        self._buffer += data
+        self._position += size
+
+        if len(self._buffer) >= self._part_size:
+            self._upload_buffer()
+
+        return size
+
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        if self._before_complete is not None:
+            try:
+                self._before_complete()
+            except Exception:
+                self.abort()
+                raise
+
+        self.closed = True
+
+        if self._upload_id is None:
+            self._s3_client.put_object(Bucket=self._bucket, Key=self._key, Body=self._buffer)
+            return
+
+        try:
+            if self._buffer:
+                self._upload_buffer()
+
+            parts = [future.result() for future in self._parts]
+
+            self._s3_client.complete_multipart_upload(
+                Bucket=self._bucket,
+                Key=self._key,
+                UploadId=self._upload_id,
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self._abort_upload()
+            raise
+        finally:
+            self._executor.shutdown()
+
+    def abort(self) -> None:
+        if self.closed:
+            return
+
+        self.closed = True
+
+        if self._upload_id is not None:
+            self._executor.shutdown()
+            self._abort_upload()
+
+    def _upload_buffer(self) -> None:
+        if self._upload_id is None:
+            response = self._s3_client.create_multipart_upload(Bucket=self._bucket, Key=self._key)
+
+            self._upload_id = response['UploadId']
+            self._executor = ThreadPoolExecutor(max_workers=self._max_workers)
+
+        pending_parts = [future for future in self._parts if not future.done()]
+
+        if len(pending_parts) >= self._max_workers:
+            pending_parts[0].result()
+
+        self._parts.append(self._executor.submit(self._upload_part, len(self._parts) + 1, self._buffer))
+        self._buffer = bytearray()
+
+    def _upload_part(self, part_number: int, body: bytearray) -> dict:
+        response = self._s3_client.upload_part(
+            Bucket=self._bucket,
+            Key=self._key,
+            UploadId=self._upload_id,
+            PartNumber=part_number,
+            Body=body
+        )
+
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+    def _abort_upload(self) -> None:
+        self._s3_client.abort_multipart_upload(Bucket=self._bucket, Key=self._key, UploadId=self._upload_id)
+
+
+def get_object_metadata_from_s3(s3_client, bucket: str, key: str) -> dict:
+    return s3_client.head_object(
+        Bucket=bucket,
+        Key=key
     )
 
 
+def object_exists_in_s3(s3_client, bucket: str, key: str) -> bool:
+    try:
+        get_object_metadata_from_s3(s3_client, bucket, key)
+    except ClientError as ex:
+        if ex.response.get('Error', {}).get('Code') in NOT_FOUND_ERROR_CODES:
+            return False
+
+        raise ex
+
+    return True
+
+
 def copy_object_in_s3(s3_client, bucket: str, from_key: str, to_key: str):
     s3_client.copy_object(
         Bucket=bucket,